@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+import sys, os, time, json, shutil, argparse, tempfile, tracemalloc, datetime
+import subprocess
+from ledger_functions import *
+
+# Benchmarks of the hot paths of ledger_functions on synthetic journals
+# Usage: python3 benchmark.py [--sizes 1000 10000] [--output results.json]
+# Each function is run at each size (number of journal entries) and the wall
+# time, the number of subprocesses started and (in a second, traced run) the
+# peak memory allocated by Python (tracemalloc) are reported and saved as json so that runs can be
+# compared. Benchmarks that need the ledger binary are skipped if it is absent
+
+############          Synthetic data         ############
+
+def make_synthetic_data(path, n_accounts = 20, n_commodities = 50,
+                        opg_date = '2014-03-31', seed = 0):
+    # writes account, opening balance, commodity and price csv files in the
+    # layout of the example folder and returns the fnames dict for them
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok = True)
+    f = lambda name: os.path.join(path, opg_date + '-' + name + '.csv')
+    banks = ['Assets:Bank:Bank {:}'.format(i) for i in range(n_accounts)]
+    expenses = ['Expenses:Expense {:}'.format(i) for i in range(n_accounts)]
+    incomes = ['Income:Income {:}'.format(i) for i in range(n_accounts)]
+    others = ['Assets:Stocks', 'Income:Capital Gains',
+              'Excess of Income over Expenses', 'Equity',
+              'Equity:Opening Balance']
+    aliases = ['bank{:}'.format(i) for i in range(n_accounts)] \
+        + ['exp{:}'.format(i) for i in range(n_accounts)] \
+        + ['inc{:}'.format(i) for i in range(n_accounts)] \
+        + ['stock', 'gain', 'surplus', 'equity', 'opening balance']
+    pd.DataFrame({'full_name' : banks + expenses + incomes + others,
+                  'name' : aliases}).to_csv(f('account-list'), index = False)
+    pd.DataFrame({'Account' : aliases[:n_accounts],
+                  'Amount' : rng.integers(10000, 1000000, n_accounts)}).to_csv(
+                      f('opening-money-balances'), index = False)
+    codes = ['C{:04d}'.format(i) for i in range(n_commodities)]
+    prices = rng.uniform(10, 1000, n_commodities).round(2)
+    qty = rng.integers(1, 500, n_commodities)
+    pd.DataFrame({'code' : codes, 'name' : ['Company ' + c for c in codes]}).to_csv(
+        f('stocks-names'), index = False)
+    pd.DataFrame({'account' : 'stock', 'code' : codes, 'qty' : qty,
+                  'cost' : (qty * prices).round(2)}).to_csv(
+                      f('stocks-quantity-cost'), index = False)
+    pd.DataFrame({'code' : codes, 'price' : prices}).to_csv(
+        f('stocks-prices'), index = False)
+    return dict(accounts = f('account-list'),
+                money_balances = f('opening-money-balances'),
+                commodity_balances = [f('stocks-quantity-cost')],
+                commodity_codes = [f('stocks-names')],
+                opening_price_data = [f('stocks-prices')])
+
+def make_synthetic_je_list(n_entries, n_accounts = 20, n_commodities = 50,
+                           trade_fraction = 0.2, sell_fraction = 0.5,
+                           year = 2015, seed = 0):
+    # returns a je_list of n_entries entries dated in the financial year
+    # a trade_fraction of the entries are commodity buys or (sell_fraction of
+    # these) sells with the gain going to an auto balanced account
+    # the rest are expenses or incomes paid from or into a bank account
+    rng = np.random.default_rng(seed)
+    start = datetime.date(year - 1, 4, 1)
+    days = rng.integers(0, 365, n_entries)
+    kinds = rng.uniform(size = n_entries)
+    banks = rng.integers(0, n_accounts, n_entries)
+    heads = rng.integers(0, n_accounts, n_entries)
+    codes = rng.integers(0, n_commodities, n_entries)
+    amounts = rng.uniform(100, 100000, n_entries).round(2)
+    qty = rng.integers(1, 100, n_entries)
+    je_list = []
+    for i in range(n_entries):
+        date = str(start + datetime.timedelta(days = int(days[i])))
+        bank = 'bank{:}'.format(banks[i])
+        code = 'C{:04d}'.format(codes[i])
+        if kinds[i] < trade_fraction * (1 - sell_fraction):
+            je_list.append([(date, 'Buy ' + code), (bank, -amounts[i]),
+                            ('stock', qty[i], code, amounts[i])])
+        elif kinds[i] < trade_fraction:
+            cost = round(amounts[i] / qty[i], 6)
+            price = round(cost * rng.uniform(0.5, 2), 6)
+            je_list.append([(date, 'Sell ' + code),
+                            ('stock', -qty[i], code, cost, price),
+                            (bank, round(qty[i] * price, 2)), ('gain', )])
+        elif kinds[i] < (1 + trade_fraction) / 2:
+            je_list.append([(date, 'Expense'), ('exp{:}'.format(heads[i]),
+                                                amounts[i]), (bank, )])
+        else:
+            je_list.append([(date, 'Income'), ('inc{:}'.format(heads[i]),
+                                               -amounts[i]), (bank, )])
+    return je_list
+
+
+############          Measurement         ############
+
+subprocess_count = [0]
+
+# every subprocess (including those of subprocess.run) is started by Popen
+class CountedPopen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        subprocess_count[0] += 1
+        super().__init__(*args, **kwargs)
+
+subprocess.Popen = CountedPopen
+
+def measure(function, *args):
+    # returns wall time, number of subprocesses and peak Python memory
+    # the function is run twice, since tracemalloc slows down Python code: once
+    # untraced for the time and subprocesses and once traced for the memory
+    # (the ledger check cache is cleared so that both runs do the same work)
+    ledger_check_cache.clear()
+    subprocess_count[0] = 0
+    start = time.perf_counter()
+    function(*args)
+    wall = time.perf_counter() - start
+    subprocesses = subprocess_count[0]
+    ledger_check_cache.clear()
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'wall_time' : wall, 'subprocesses' : subprocesses,
+            'peak_memory' : peak}
+
+def run_benchmarks(sizes, n_accounts, n_commodities, trade_fraction):
+    has_ledger = shutil.which('ledger') is not None
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        fnames = make_synthetic_data(path, n_accounts, n_commodities)
+        pricedb = os.path.join(path, 'prices')
+        with open(pricedb, 'w') as out:
+            out.write(make_price_file(fnames['opening_price_data'],
+                                      '2014-03-31 23:59:59'))
+        opening = make_opening_ledger_list(fnames, '2014-03-31',
+                                           'opening balance')
+        json_fnames = {'pre_opening_ledger_json' : os.path.join(path, 'opg.json')}
+        for size in sizes:
+            je_list = make_synthetic_je_list(size, n_accounts, n_commodities,
+                                             trade_fraction)
+            ledger_list = opening + je_list
+            save_json(ledger_list, json_fnames['pre_opening_ledger_json'])
+            append_list = [[' '.join(je[0])] + [p for p in je[1:] if len(p) > 1]
+                           for je in je_list]
+            def append_in_chunks():
+                ledger = ''
+                for k in range(0, len(append_list), 100):
+                    ledger = ledger_append(ledger, append_list[k:k + 100],
+                                           '2015-03-31')
+            def append_to_builder():
+                ledger = LedgerBuilder()
+                for k in range(0, len(append_list), 100):
+                    ledger = ledger_append(ledger, append_list[k:k + 100],
+                                           '2015-03-31')
+                ledger.getvalue()
+            def render():
+                clear_rendered_entries()
+                ledger_list_to_ledger(ledger_list)
+            benchmarks = [
+                ('make_opening_ledger_list', False, make_opening_ledger_list,
+                 (json_fnames, '2014-03-31', 'opening balance')),
+                ('ledger_list_to_ledger', False, render, ()),
+                ('ledger_append', False, append_in_chunks, ()),
+                ('ledger_append (LedgerBuilder)', False, append_to_builder, ()),
+                ('ledger_balance (native)', False, ledger_balance,
+                 (ledger_list, [], True, 'native')),
+                ('ledger_balances_df (native)', False, ledger_balances_df,
+                 (ledger_list, [], True, 'native')),
+                ('ledger_balance', True, ledger_balance,
+                 (ledger_list, [], True, 'ledger')),
+                ('ledger_balances_df', True, ledger_balances_df,
+                 (ledger_list, [], True, 'ledger')),
+                ('ledger_qty_basis_df', True, ledger_qty_basis_df,
+                 (ledger_list, pricedb))]
+            for name, needs_ledger, function, args in benchmarks:
+                result = {'function' : name, 'entries' : size}
+                if needs_ledger and not has_ledger:
+                    result['skipped'] = 'ledger binary not found'
+                else:
+                    result.update(measure(function, *args))
+                results.append(result)
+                print('{function:30} {entries:>9} '.format(**result) + (
+                    result['skipped'] if 'skipped' in result else
+                    '{wall_time:10.3f} s {subprocesses:5} subprocesses '
+                    '{peak_memory:>14,} bytes'.format(**result)))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark ledger_functions')
+    parser.add_argument('--sizes', type = int, nargs = '+',
+                        default = [1000, 10000, 100000])
+    parser.add_argument('--accounts', type = int, default = 20)
+    parser.add_argument('--commodities', type = int, default = 50)
+    parser.add_argument('--trade-fraction', type = float, default = 0.2)
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, args.accounts, args.commodities,
+                             args.trade_fraction)
+    with open(args.output, 'w') as out:
+        json.dump({'date' : str(datetime.datetime.now()),
+                   'python' : sys.version, 'pandas' : pd.__version__,
+                   'numpy' : np.__version__, 'ledger' : shutil.which('ledger'),
+                   'results' : results}, out, indent = 1)
@@ -12,14 +12,18 @@ fnames = dict(accounts = prev_yr_end + '-account-list.csv',
               commodity_codes = [prev_yr_end + '-stocks-names.csv'],
               opening_ledger = year_beg + '-opening.ledger',
               opening_ledger_json = year_beg + '-opening.json',
+              opening_ledger_snapshot = year_beg + '-opening.journal',
               opening_price_data = [prev_yr_end + '-stocks-prices.csv'],
               closing_price_data = [year_end + '-stocks-prices.csv'],
               opening_pricedb = prev_yr_end + '-prices',
               closing_pricedb = year_end + '-prices',
+              closing_price_store = year_end + '-prices.pkl',
               pre_closing = year_end + '-pre-closing.ledger',
               post_closing = year_end + '-post-closing.ledger',
               pre_closing_json = year_end + '-pre-closing.json',
               post_closing_json = year_end + '-post-closing.json',
+              pre_closing_snapshot = year_end + '-pre-closing.journal',
+              post_closing_snapshot = year_end + '-post-closing.journal',
               closing_commodity_balances = year_end + '-qty-cost-value.csv'
 )
 
@@ -1,6 +1,13 @@
 import numpy as np
 import pandas as pd
-import io, subprocess, re, json
+import io, subprocess, re, json, csv, os, hashlib, tempfile, threading, time
+import asyncio, atexit
+from contextlib import contextmanager
+from array import array
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    wait, FIRST_COMPLETED
 
 money = 'INR' # default currency is Indian Rupee (INR)
 
@@ -35,16 +42,33 @@ def ledger_format(type = 'standard'):
     }[type]
 
 
+@lru_cache(maxsize = None)
+def commodity_suffix(commodity):
+    # compiled pattern of a trailing commodity name (quoted or not) with spaces
+    # the name is escaped as it may contain regex metacharacters
+    name = re.escape(commodity)
+    return re.compile(r'\s(?:' + name + '|"' + name + r'")\s.*$')
+
 def myfloat(s, commodity = money):
     s = s.replace(',', '') # remove thousand separators (,)
-    s = re.sub('\s' + commodity + '\s.*$', '', s) # remove trailing commodity name with spaces
-    s = re.sub('\s"' + commodity + '"\s.*$', '', s) # remove trailing quoted commodity name with spaces
+    s = commodity_suffix(commodity).sub('', s) # remove trailing commodity name
     return float(s) # the string s is now numeric and can be converted using float
 
-def make_opening_ledger_list(fnames, opg_date, opg_balance_account):
-    if 'pre_opening_ledger_json' in fnames.keys():
+def make_opening_ledger_list(fnames, opg_date, opg_balance_account,
+                             pre_opening_ledger_list = None):
+    # the previous year's ledger is pre_opening_ledger_list if it is given (for
+    # example, by a multi-year batch run), else it is read from its binary
+    # snapshot (see save_journal) if there is one, else from its json file
+    first_year = False
+    if pre_opening_ledger_list is not None:
+        ledger_list = list(pre_opening_ledger_list)
+    elif 'pre_opening_ledger_snapshot' in fnames.keys():
+        ledger_list = load_journal(
+            fnames['pre_opening_ledger_snapshot']).to_ledger_list()
+    elif 'pre_opening_ledger_json' in fnames.keys():
         ledger_list = json.load(open(fnames['pre_opening_ledger_json'], 'r'))
     else:
+        first_year = True
         ledger_list = []
         first_year_data = ['accounts', 'money_balances', 'commodity_balances',
                            'commodity_codes']
@@ -59,19 +83,19 @@ def make_opening_ledger_list(fnames, opg_date, opg_balance_account):
     else:
         money_balance = pd.DataFrame()
     commodity_bal = pd.DataFrame()
-    if 'commodity_balances' in fnames.keys():
-        for f in fnames['commodity_balances']:
-            commodity_bal = commodity_bal.append(pd.read_csv(f, header =0))
+    if fnames.get('commodity_balances'):
+        commodity_bal = pd.concat([pd.read_csv(f, header =0)
+                                   for f in fnames['commodity_balances']])
     commodity_codes = pd.DataFrame()
-    if 'commodity_codes' in fnames.keys():
-        for f in fnames['commodity_codes']:
-            commodity_codes = commodity_codes.append(pd.read_csv(f, header =0))
+    if fnames.get('commodity_codes'):
+        commodity_codes = pd.concat([pd.read_csv(f, header =0)
+                                     for f in fnames['commodity_codes']])
     # account information
     for _, account, alias in tree.itertuples():
         if not pd.isnull(alias):
             ledger_list.append([('account ', account), ('alias', alias.lower())])
     # commodity information
-    if 'pre_opening_ledger_json' not in fnames.keys():
+    if first_year:
         ledger_list.append([('commodity', 'INR'),
                             ('note', 'Indian Rupees'),
                             ('format', '\N{INDIAN RUPEE SIGN} 1,000.00'),
@@ -91,93 +115,1157 @@ def make_opening_ledger_list(fnames, opg_date, opg_balance_account):
                             (opg_balance_account, )])
     return(ledger_list)
 
-def ledger_list_to_ledger(ledger_list):
+def ledger_entry_to_ledger(ledger_entry):
+    # returns the text of one entry (directive or journal entry) of a ledger_list
     with io.StringIO() as out:
-        for (directive, details), *tail in ledger_list:
-            # account information
-            if re.match('account', directive):
-                print(ledger_format('account_decl').format(details), file = out)
-                for sub_directive in tail:
-                      print(ledger_format('sub_directive').format(
-                          *sub_directive), file = out)
-            # commodity information
-            elif re.match('commodity', directive):
-                print(ledger_format('commodity_decl').format(details),
-                      file = out)
-                for sub_directive in tail:
-                      print(ledger_format('sub_directive').format(
-                          *sub_directive), file = out)
-            # journal entries
-            elif re.search('^[0-9]+', directive):
-                print(ledger_format('date_line').format(directive, details),
-                      file = out)
-                for entry in tail:
-                    if len(entry) == 1: # only account (amount is auto)
-                        account, = entry
-                        print(ledger_format('auto').format(account), file = out)
-                    elif len(entry) == 2: # account and amount
-                        account, amount = entry
-                        print(ledger_format('standard').format(
-                            account, amount), file = out)
-                    elif len(entry) == 4: # commodity buy (account, qty, code, cost)
-                        account, qty, code, cost = entry
-                        print(ledger_format('commodity_buy').format(
-                            account, qty, code, cost), file = out)
-                    elif len(entry) == 5: # commodity sell (account, qty, code, cost, price)
-                        account, qty, code, cost, price = entry
-                        print(ledger_format('commodity_sell').format(
-                            account, qty, code, cost, price), file = out)
-                    else:
-                        assert False, 'Entry has unknown length:' + str(entry)
-            else:
-                assert False, 'Unknown directive:' + directive
-        return(out.getvalue())
-        
-def ledger_append(ledger, entry_list, entry_date):
-    with io.StringIO(ledger) as out:
-        out.seek(0, io.SEEK_END)
-        for je in entry_list:
-            if re.match(r'^\d\d', je[0]): # if the first line has a date, we use it as is
-                print(je[0], file = out)
-            else: # if the first line does not have a date, we prepend the default entry_date
-                print(entry_date, je[0], file = out)
-            for item in je[1:]:
-                if len(item) == 2: # account and amount
-                    account, amount = item
-                    print(ledger_format().format(account, amount),
-                          file = out)
-                elif len(item) == 4:  # commodity buy (account, qty, code, cost)
-                    account, units, code, cost = item
+        (directive, details), *tail = ledger_entry
+        # account information
+        if re.match('account', directive):
+            print(ledger_format('account_decl').format(details), file = out)
+            for sub_directive in tail:
+                  print(ledger_format('sub_directive').format(
+                      *sub_directive), file = out)
+        # commodity information
+        elif re.match('commodity', directive):
+            print(ledger_format('commodity_decl').format(details),
+                  file = out)
+            for sub_directive in tail:
+                  print(ledger_format('sub_directive').format(
+                      *sub_directive), file = out)
+        # journal entries
+        elif re.search('^[0-9]+', directive):
+            print(ledger_format('date_line').format(directive, details),
+                  file = out)
+            for entry in tail:
+                if len(entry) == 1: # only account (amount is auto)
+                    account, = entry
+                    print(ledger_format('auto').format(account), file = out)
+                elif len(entry) == 2: # account and amount
+                    account, amount = entry
+                    print(ledger_format('standard').format(
+                        account, amount), file = out)
+                elif len(entry) == 4: # commodity buy (account, qty, code, cost)
+                    account, qty, code, cost = entry
                     print(ledger_format('commodity_buy').format(
-                        account, units, code, cost), file = out)
-                elif len(item) == 5: # commodity sell (account, qty, code, cost, price)
-                    account, qty, code, cost, price = item
+                        account, qty, code, cost), file = out)
+                elif len(entry) == 5: # commodity sell (account, qty, code, cost, price)
+                    account, qty, code, cost, price = entry
                     print(ledger_format('commodity_sell').format(
                         account, qty, code, cost, price), file = out)
+                else:
+                    assert False, 'Entry has unknown length:' + str(entry)
+        else:
+            assert False, 'Unknown directive:' + directive
+        return(out.getvalue())
+
+# while a rendering_cache is active, the text of every entry rendered by
+# ledger_list_to_ledger is remembered (by the identity of the entry) so that a
+# ledger_list that extends one rendered earlier (for example,
+# opening_ledger_list + je_list) formats only its new entries
+# hence entries must not be modified in place after they have been rendered
+# the cache is dropped when the outermost rendering_cache ends so that the
+# text is not kept for the life of the process
+rendered_entries = None
+
+@contextmanager
+def rendering_cache():
+    # can also be used as a decorator of a function (for example, close_accounts)
+    global rendered_entries
+    outermost = rendered_entries is None
+    if outermost:
+        rendered_entries = {}
+    try:
+        yield
+    finally:
+        if outermost:
+            rendered_entries = None
+
+def rendered_entry(entry):
+    cache = rendered_entries
+    if cache is None:
+        return ledger_entry_to_ledger(entry)
+    cached = cache.get(id(entry))
+    if cached is None or cached[0] is not entry:
+        cached = (entry, ledger_entry_to_ledger(entry)) # keep entry so id is not reused
+        cache[id(entry)] = cached
+    return cached[1]
+
+def clear_rendered_entries():
+    if rendered_entries is not None:
+        rendered_entries.clear()
+
+def ledger_list_to_ledger(ledger_list, out = None):
+    # returns the text of ledger_list (or of a Journal or LedgerBuilder) in
+    # ledger's format
+    # if out (a file or stream) is given, the text is written to it instead
+    # so that the text of the whole ledger is never held in memory
+    if isinstance(ledger_list, LedgerBuilder):
+        if out is not None:
+            return ledger_list.write(out)
+        return ledger_list.getvalue()
+    if isinstance(ledger_list, Journal):
+        if out is not None:
+            return ledger_list.write(out)
+        with io.StringIO() as text:
+            ledger_list.write(text)
+            return(text.getvalue())
+    if out is not None:
+        out.writelines(rendered_entry(entry) for entry in ledger_list)
+        return
+    return(''.join([rendered_entry(entry) for entry in ledger_list]))
+        
+class Journal:
+    # compact columnar representation of a ledger_list
+    # every string (directive, date, narration, account, commodity) is stored once
+    # in the string table (strings) and is referred to by its index
+    # entry i has a header (entry_head, entry_details, entry_kind) and the postings
+    # entry_offsets[i] to entry_offsets[i+1]; each posting has a kind, an account
+    # (the name of a sub directive in a declaration), a commodity (the value of
+    # a sub directive) and the numeric columns qty, amount, cost and price
+    # unused fields are -1 (strings) or nan (numbers)
+    # iterating over a Journal gives the entries in ledger_list format
+    ACCOUNT_DECL, COMMODITY_DECL, JOURNAL_ENTRY = range(3) # entry kinds
+    SUB_DIRECTIVE, AUTO, AMOUNT, BUY, SELL = range(5) # posting kinds
+
+    # typecodes (array module) of the columns
+    columns = {'entry_head' : 'i', 'entry_details' : 'i', 'entry_kind' : 'b',
+               'entry_offsets' : 'q', 'post_kind' : 'b', 'post_account' : 'i',
+               'post_commodity' : 'i', 'post_qty' : 'd', 'post_amount' : 'd',
+               'post_cost' : 'd', 'post_price' : 'd'}
+
+    def __init__(self, ledger_list = []):
+        self.strings = []
+        self.string_index = {}
+        for name, typecode in self.columns.items():
+            setattr(self, name, array(typecode))
+        self.entry_offsets.append(0)
+        self.extend(ledger_list)
+
+    @classmethod
+    def from_columns(cls, strings, columns):
+        # creates a Journal from a string table and a dict of columns
+        # (numpy arrays, which can be memory mapped, or arrays)
+        journal = cls()
+        journal.strings = list(strings)
+        journal.string_index = {s : i for i, s in enumerate(journal.strings)}
+        for name in cls.columns:
+            setattr(journal, name, columns[name])
+        return journal
+
+    def appendable(self):
+        # converts columns which are numpy arrays (e.g. loaded by load_journal)
+        # into arrays so that entries can be appended
+        for name, typecode in self.columns.items():
+            values = getattr(self, name)
+            if isinstance(values, np.ndarray):
+                setattr(self, name, array(typecode, values.astype(
+                    np.dtype(typecode)).tobytes()))
+
+    def intern(self, s):
+        index = self.string_index.get(s)
+        if index is None:
+            index = self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return index
+
+    def add_posting(self, kind, account, commodity = None, qty = np.nan,
+                    amount = np.nan, cost = np.nan, price = np.nan):
+        self.post_kind.append(kind)
+        self.post_account.append(self.intern(account))
+        self.post_commodity.append(-1 if commodity is None
+                                   else self.intern(str(commodity)))
+        self.post_qty.append(qty)
+        self.post_amount.append(amount)
+        self.post_cost.append(cost)
+        self.post_price.append(price)
+
+    def append(self, ledger_entry):
+        self.appendable()
+        (directive, details), *tail = ledger_entry
+        if re.match('account', directive):
+            kind = self.ACCOUNT_DECL
+        elif re.match('commodity', directive):
+            kind = self.COMMODITY_DECL
+        elif re.search('^[0-9]+', directive):
+            kind = self.JOURNAL_ENTRY
+        else:
+            assert False, 'Unknown directive:' + directive
+        self.entry_head.append(self.intern(directive))
+        # details and commodity codes are interned as text so that a numeric
+        # commodity code (e.g. read by pd.read_csv) matches its declaration
+        self.entry_details.append(self.intern(str(details)))
+        self.entry_kind.append(kind)
+        for entry in tail:
+            if kind != self.JOURNAL_ENTRY: # (sub directive, value)
+                self.add_posting(self.SUB_DIRECTIVE, *entry)
+            elif len(entry) == 1: # only account (amount is auto)
+                self.add_posting(self.AUTO, entry[0])
+            elif len(entry) == 2: # account and amount
+                self.add_posting(self.AMOUNT, entry[0], amount = entry[1])
+            elif len(entry) == 4: # commodity buy (account, qty, code, cost)
+                account, qty, code, cost = entry
+                self.add_posting(self.BUY, account, code, qty, cost = cost)
+            elif len(entry) == 5: # commodity sell (account, qty, code, cost, price)
+                account, qty, code, cost, price = entry
+                self.add_posting(self.SELL, account, code, qty, cost = cost,
+                                 price = price)
+            else:
+                assert False, 'Entry has unknown length:' + str(entry)
+        self.entry_offsets.append(len(self.post_kind))
+
+    def extend(self, ledger_list):
+        for ledger_entry in ledger_list:
+            self.append(ledger_entry)
+
+    def column(self, name):
+        # returns a column (e.g. 'post_amount') as a numpy array
+        # arrays are copied because an array cannot grow while numpy uses its buffer
+        values = getattr(self, name)
+        return values if isinstance(values, np.ndarray) else np.array(values)
+
+    def __len__(self):
+        return len(self.entry_kind)
+
+    def entries(self):
+        # yields (kind, head, details, postings) for each entry where postings
+        # is a list of (kind, account, commodity, qty, amount, cost, price)
+        strings = self.strings + [None] # index -1 gives None
+        posts = zip(self.post_kind, (strings[i] for i in self.post_account),
+                    (strings[i] for i in self.post_commodity), self.post_qty,
+                    self.post_amount, self.post_cost, self.post_price)
+        for kind, head, details, start, end in zip(
+                self.entry_kind, self.entry_head, self.entry_details,
+                self.entry_offsets, self.entry_offsets[1:]):
+            yield (kind, strings[head], strings[details],
+                   list(islice(posts, end - start)))
+
+    def __iter__(self):
+        for kind, head, details, postings in self.entries():
+            ledger_entry = [(head, details)]
+            for post_kind, account, code, qty, amount, cost, price in postings:
+                if post_kind == self.SUB_DIRECTIVE:
+                    ledger_entry.append((account, code))
+                elif post_kind == self.AUTO:
+                    ledger_entry.append((account, ))
+                elif post_kind == self.AMOUNT:
+                    ledger_entry.append((account, amount))
+                elif post_kind == self.BUY:
+                    ledger_entry.append((account, qty, code, cost))
+                else:
+                    ledger_entry.append((account, qty, code, cost, price))
+            yield ledger_entry
+
+    def to_ledger_list(self):
+        return list(self)
+
+    def write(self, out):
+        # writes the text of the journal in ledger's format to a file or stream
+        formats = {kind : ledger_format(kind) + '\n' for kind in [
+            'account_decl', 'commodity_decl', 'sub_directive', 'date_line',
+            'auto', 'standard', 'commodity_buy', 'commodity_sell']}
+        head_format = {self.ACCOUNT_DECL : formats['account_decl'],
+                       self.COMMODITY_DECL : formats['commodity_decl']}
+        for kind, head, details, postings in self.entries():
+            if kind == self.JOURNAL_ENTRY:
+                out.write(formats['date_line'].format(head, details))
+            else:
+                out.write(head_format[kind].format(details))
+            for post_kind, account, code, qty, amount, cost, price in postings:
+                if post_kind == self.SUB_DIRECTIVE:
+                    out.write(formats['sub_directive'].format(account, code))
+                elif post_kind == self.AUTO:
+                    out.write(formats['auto'].format(account))
+                elif post_kind == self.AMOUNT:
+                    out.write(formats['standard'].format(account, amount))
+                elif post_kind == self.BUY:
+                    out.write(formats['commodity_buy'].format(
+                        account, qty, code, cost))
+                else:
+                    out.write(formats['commodity_sell'].format(
+                        account, qty, code, cost, price))
+
+def as_journal(ledger_list):
+    if isinstance(ledger_list, LedgerFile):
+        ledger_list = ledger_list.ledger_list
+    return ledger_list if isinstance(ledger_list, Journal) else Journal(ledger_list)
+
+# A Journal can be saved as a binary snapshot which is much smaller and faster
+# to write and read than json: the file starts with snapshot_magic and the length
+# of a json header (string table and dtype, offset and length of each column)
+# followed by the raw columns, each aligned to 8 bytes so that they can be
+# memory mapped by load_journal without reading or parsing the file
+snapshot_magic = b'LEDGERJ1'
+
+def save_journal(ledger_list, filename):
+    # saves a ledger_list (or Journal) as a binary snapshot
+    journal = as_journal(ledger_list)
+    columns = {name : journal.column(name).astype(
+                   np.dtype(typecode).newbyteorder('<'))
+               for name, typecode in Journal.columns.items()}
+    header = {'strings' : journal.strings, 'columns' : {}}
+    offset = 0
+    for name, values in columns.items():
+        header['columns'][name] = [values.dtype.str, offset, len(values)]
+        offset += -(-values.nbytes // 8) * 8
+    header = json.dumps(header, cls = Numpy_int64_Encoder).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+    with open(filename, 'wb') as out:
+        out.write(snapshot_magic + len(header).to_bytes(8, 'little') + header)
+        for values in columns.values():
+            out.write(values.tobytes() + b'\0' * (-values.nbytes % 8))
+
+def load_journal(filename):
+    # loads a binary snapshot saved by save_journal as a Journal whose columns
+    # are memory mapped numpy arrays
+    with open(filename, 'rb') as f:
+        assert f.read(len(snapshot_magic)) == snapshot_magic, \
+            filename + ' is not a journal snapshot'
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    start = len(snapshot_magic) + 8 + header_length
+    columns = {name : np.memmap(filename, dtype = dtype, mode = 'r',
+                                offset = start + offset, shape = (length, ))
+                      if length > 0 else np.zeros(0, dtype = dtype)
+               for name, (dtype, offset, length) in header['columns'].items()}
+    return Journal.from_columns(header['strings'], columns)
+
+def json_to_snapshot(json_file, snapshot_file):
+    # converts a ledger_list saved by save_json into a binary snapshot
+    with open(json_file, 'r') as f:
+        save_journal(json.load(f), snapshot_file)
+
+def appended_entry_to_ledger(je):
+    # returns the text of an entry in ledger_append format: the first line as a
+    # string (with its date) followed by postings (account and amount, commodity
+    # buy or commodity sell)
+    with io.StringIO() as out:
+        print(je[0], file = out)
+        for item in je[1:]:
+            if len(item) == 2: # account and amount
+                account, amount = item
+                print(ledger_format().format(account, amount),
+                      file = out)
+            elif len(item) == 4:  # commodity buy (account, qty, code, cost)
+                account, units, code, cost = item
+                print(ledger_format('commodity_buy').format(
+                    account, units, code, cost), file = out)
+            elif len(item) == 5: # commodity sell (account, qty, code, cost, price)
+                account, qty, code, cost, price = item
+                print(ledger_format('commodity_sell').format(
+                    account, qty, code, cost, price), file = out)
         return(out.getvalue())
 
+class LedgerBuilder:
+    # append-only builder of the text of a ledger
+    # append (one entry) and extend (a list or generator of entries) only store
+    # the entries, which are rendered when the text is needed (getvalue or
+    # write) so that a ledger built by many appends is rendered and joined once
+    # instead of being copied at every append
+    # an entry is in ledger_list format or in ledger_append format (first line
+    # as a string); in the latter, entry_date is prepended to a first line
+    # without a date when the entry is appended
+    # if out (a file or stream) is given, the entries are written to it every
+    # chunk_size entries (and by flush) and are then forgotten
+    def __init__(self, ledger = '', entry_date = None, out = None,
+                 chunk_size = 10000):
+        self.entry_date = entry_date
+        self.out = out
+        self.chunk_size = chunk_size
+        self.parts = [ledger] if ledger else [] # text already rendered
+        self.pending = [] # entries not yet rendered
+
+    def append(self, entry, entry_date = None):
+        if isinstance(entry[0], str) and not re.match(r'^\d\d', entry[0]):
+            # if the first line does not have a date, we prepend the default date
+            date = self.entry_date if entry_date is None else entry_date
+            entry = ['{:} {:}'.format(date, entry[0])] + list(entry[1:])
+        self.pending.append(entry)
+        if self.out is not None and len(self.pending) >= self.chunk_size:
+            self.flush()
+        return self
+
+    def extend(self, entries, entry_date = None):
+        for entry in entries:
+            self.append(entry, entry_date)
+        return self
+
+    def render(self):
+        # renders the pending entries into the text parts
+        self.parts += [appended_entry_to_ledger(entry) if isinstance(entry[0], str)
+                       else ledger_entry_to_ledger(entry)
+                       for entry in self.pending]
+        self.pending = []
+
+    def flush(self):
+        # writes the text so far to out (if given) and forgets it
+        self.render()
+        if self.out is not None:
+            self.out.writelines(self.parts)
+            self.out.flush()
+            self.parts = []
+        return self
+
+    def write(self, out):
+        # writes the text to out (without keeping the rendered entries)
+        out.writelines(self.parts)
+        out.writelines(appended_entry_to_ledger(entry) if isinstance(entry[0], str)
+                       else ledger_entry_to_ledger(entry)
+                       for entry in self.pending)
+
+    def getvalue(self):
+        assert self.out is None, 'The text has been written to out'
+        self.render()
+        self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+def ledger_append(ledger, entry_list, entry_date):
+    # appends the entries in entry_list (in ledger_append format, see
+    # LedgerBuilder) to ledger and returns the text of the ledger
+    # if ledger is a LedgerBuilder, the entries are added to it without copying
+    # the text and it is returned, so that repeated appends take constant time
+    if isinstance(ledger, LedgerBuilder):
+        return ledger.extend(entry_list, entry_date)
+    return LedgerBuilder(ledger, entry_date).extend(entry_list).getvalue()
+
 class LedgerError(Exception):
     def __str__(self):
         return "Ledger file is not OK"
     
-def ledger_check(ledger):
+# ledgers that have passed the 'source' check are remembered by a digest of their
+# text (and the strict flag) so that they are not checked again in this process
+# if ledger_check_cache_dir is set (or LEDGER_CHECK_CACHE_DIR in the environment)
+# the digests are also stored as empty files in that folder to survive re-runs
+ledger_check_cache = set()
+ledger_check_cache_dir = os.environ.get('LEDGER_CHECK_CACHE_DIR')
+ledger_check_stats = {'hits' : 0, 'misses' : 0}
+
+def file_digest(filename):
+    # SHA-256 digest of the contents of a file, read in blocks
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class LedgerFile:
+    # the text of a ledger written once to a file so that every ledger command
+    # reads it with '-f path' instead of receiving a copy of the text through a pipe
+    # ledger can be text, a ledger_list, a Journal or a LedgerBuilder; if filename
+    # is not given, the text is written to an anonymous in-memory file (memfd) on
+    # Linux or else to a temporary file, which is removed by close (or at the end
+    # of a with block)
+    # digest is the SHA-256 digest of the text; ledger_list is kept (if given)
+    # so that the native balance backend can still be used
+    def __init__(self, ledger, filename = None):
+        self.ledger_list = None if isinstance(ledger, (str, LedgerBuilder)) \
+            else ledger
+        self.fd, self.temporary = None, filename is None
+        self.closed = False
+        if filename is not None:
+            self.path = filename
+            out = open(filename, 'w')
+        elif hasattr(os, 'memfd_create'):
+            self.fd = os.memfd_create('ledger')
+            self.path = '/proc/{:}/fd/{:}'.format(os.getpid(), self.fd)
+            out = open(self.fd, 'w', closefd = False)
+        else:
+            out = tempfile.NamedTemporaryFile('w', suffix = '.ledger',
+                                              delete = False)
+            self.path = out.name
+        with out:
+            if isinstance(ledger, str):
+                out.write(ledger)
+            else:
+                ledger_list_to_ledger(ledger, out)
+        self.digest = file_digest(self.path)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        elif self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+        self.fd, self.temporary = None, False
+        self.closed = True # the path may no longer refer to this ledger
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def ledger_digest(ledger, strict = False):
+    # digest of the text of ledger (or of a LedgerFile) and the strict flag
+    text = ledger.digest if isinstance(ledger, LedgerFile) else ledger
+    return hashlib.sha256((('strict:' if strict else 'lax:') + text).encode(
+        'utf-8')).hexdigest()
+
+def ledger_source(ledger):
+    # returns the '-f' arguments and the input for running ledger on ledger
+    # (a LedgerFile is read from its path, text is sent through stdin)
+    if isinstance(ledger, LedgerFile):
+        return ['-f', ledger.path], None
+    return ['-f', '-'], ledger
+
+# Profiling: when profile is a list (LEDGER_PROFILE set in environment or
+# start_profile() called) every ledger run appends a record with its stage,
+# kind, ledger arguments, wall time, bytes sent and read and return code, and
+# every stage run by run_stage appends a record with its wall time
+# when profile is None nothing is recorded (a single check per call)
+profile = [] if os.environ.get('LEDGER_PROFILE') else None
+current_stage = threading.local() # name of the stage running in each thread
+
+def start_profile():
+    global profile
+    profile = []
+
+def profile_record(kind, start, **fields):
+    profile.append(dict(stage = getattr(current_stage, 'name', None),
+                        kind = kind, time = time.perf_counter() - start,
+                        **fields))
+
+class CountingReader:
+    # wraps a text stream and counts the bytes of the text read from it
+    # (so that the output read by the caller of ledger_output is recorded)
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def count(self, text):
+        self.bytes += len(text.encode())
+        return text
+
+    def read(self, size = -1):
+        return self.count(self.stream.read(size))
+
+    def readline(self, size = -1):
+        return self.count(self.stream.readline(size))
+
+    def __iter__(self):
+        return (self.count(line) for line in self.stream)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def run_stage(name, function, *args):
+    # calls function(*args) as the stage name: ledger runs made during it are
+    # recorded with this name and its own wall time is recorded at the end
+    if profile is None:
+        return function(*args)
+    previous = getattr(current_stage, 'name', None)
+    current_stage.name = name
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        profile_record('stage', start)
+        current_stage.name = previous
+
+def run_stage_in_process(enabled, name, function, *args):
+    # run_stage for a worker process: returns (result, records) so that the
+    # records can be added to the profile of the parent by stage_result
+    global profile
+    profile = [] if enabled else None
+    return run_stage(name, function, *args), profile
+
+def submit_stage(pool, name, function, *args, processes = False):
+    # submits a stage to a pool of threads or processes (see run_stage)
+    if profile is None:
+        return pool.submit(function, *args)
+    if processes:
+        return pool.submit(run_stage_in_process, True, name, function, *args)
+    return pool.submit(run_stage, name, function, *args)
+
+def stage_result(future, processes = False):
+    # result of a future from submit_stage
+    if profile is None or not processes:
+        return future.result()
+    result, records = future.result()
+    profile.extend(records)
+    return result
+
+def profile_summary():
+    # table of the profile by stage: wall time of the stage, number of ledger
+    # runs, their total time, bytes sent and read, and the time spent in
+    # rendering ledger_lists; returns an empty table if there are no records
+    columns = ['stage_time', 'ledger_runs', 'ledger_time', 'bytes_in',
+               'bytes_out', 'render_time']
+    if not profile:
+        return pd.DataFrame(columns = columns)
+    df = pd.DataFrame(profile)
+    df['stage'] = df['stage'].fillna('(none)')
+    kind = df['kind']
+    runs = df[kind.isin(['check', 'command', 'output', 'session'])]
+    summary = pd.DataFrame({
+        'stage_time' : df[kind == 'stage'].groupby('stage')['time'].sum(),
+        'ledger_runs' : runs.groupby('stage')['time'].count(),
+        'ledger_time' : runs.groupby('stage')['time'].sum(),
+        'bytes_in' : runs.groupby('stage')['bytes_in'].sum(),
+        'bytes_out' : runs.groupby('stage')['bytes_out'].sum(),
+        'render_time' : df[kind == 'render'].groupby('stage')['time'].sum()})
+    summary = summary[columns].fillna(0)
+    return summary.astype({'ledger_runs' : int, 'bytes_in' : int,
+                           'bytes_out' : int})
+
+def save_profile(filename):
+    # saves the profile records and the summary by stage as json
+    with open(filename, 'w') as out:
+        json.dump({'records' : profile,
+                   'summary' : profile_summary().to_dict(orient = 'index')},
+                  out, indent = 1, cls = Numpy_int64_Encoder)
+
+def ledger_check(ledger, strict = False):
     # checks ledger for syntax errors using 'source' command
-    if subprocess.run(['ledger', '-f', '-', 'source'],
-                   input = ledger, stdout=subprocess.PIPE,
-                   universal_newlines=True).returncode > 0:
+    digest = ledger_digest(ledger, strict)
+    cache_file = None if ledger_check_cache_dir is None else os.path.join(
+        ledger_check_cache_dir, digest)
+    if digest in ledger_check_cache or (
+            cache_file is not None and os.path.exists(cache_file)):
+        ledger_check_cache.add(digest)
+        ledger_check_stats['hits'] += 1
+        return
+    ledger_check_stats['misses'] += 1
+    ifstrict = ['--strict'] if strict else []
+    source, text = ledger_source(ledger)
+    start = time.perf_counter()
+    args = ['ledger'] + source + ifstrict + ['source']
+    process = subprocess.run(args, input = text, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+    if profile is not None:
+        profile_record('check', start, args = args[1:],
+                       bytes_in = 0 if text is None else len(text.encode()),
+                       bytes_out = len(process.stdout.encode()),
+                       returncode = process.returncode)
+    if process.returncode > 0:
         raise(LedgerError)
+    ledger_check_cache.add(digest)
+    if cache_file is not None:
+        os.makedirs(ledger_check_cache_dir, exist_ok = True)
+        open(cache_file, 'w').close()
     
-def ledger_command(ledger, commands, regex = [], strict = True):
+def ledger_command(ledger, commands, regex = [], strict = True, session = None):
     # run specified command on ledger and return output as a string
+    # ledger can be the text of the ledger, a LedgerFile, a ledger_list or a Journal
+    # the command is sent to session (a LedgerSession on the same ledger) if it
+    # is given or to a pooled session if use_ledger_sessions is set
+    start = time.perf_counter()
+    if not isinstance(ledger, (str, LedgerFile)):
+        ledger = ledger_list_to_ledger(ledger)
+        if profile is not None:
+            profile_record('render', start)
+    ifstrict = ['--strict'] if strict else []
+    ledger_check(ledger, strict) # first check ledger for syntax errors
+    if session is not None or use_ledger_sessions:
+        return session_command(ledger, commands + regex, strict, session)
+    source, text = ledger_source(ledger)
+    start = time.perf_counter()
+    args = ['ledger'] + source + ifstrict + commands + regex
+    process = subprocess.run(args, input = text, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+    if profile is not None:
+        profile_record('command', start, args = args[1:],
+                       bytes_in = 0 if text is None else len(text.encode()),
+                       bytes_out = len(process.stdout.encode()),
+                       returncode = process.returncode)
+    return(process.stdout)
+
+@contextmanager
+def ledger_output(ledger, commands, regex = [], strict = True, session = None):
+    # like ledger_command but yields the output as a text stream which can be
+    # read while ledger is running (for example by pd.read_csv) for large reports
+    # (the output of a session is read in full before it is yielded)
+    start = time.perf_counter()
+    if not isinstance(ledger, (str, LedgerFile)):
+        ledger = ledger_list_to_ledger(ledger)
+        if profile is not None:
+            profile_record('render', start)
     ifstrict = ['--strict'] if strict else []
-    ledger_check(ledger) # first check ledger for syntax errors
-    return(subprocess.run(['ledger', '-f', '-'] + ifstrict + commands + regex,
-                          input = ledger, stdout=subprocess.PIPE,
-                          universal_newlines=True).stdout)
+    ledger_check(ledger, strict) # first check ledger for syntax errors
+    if session is not None or use_ledger_sessions:
+        with io.StringIO(session_command(ledger, commands + regex, strict,
+                                         session)) as out:
+            yield out
+        return
+    source, text = ledger_source(ledger)
+    start = time.perf_counter()
+    args = ['ledger'] + source + ifstrict + commands + regex
+    with subprocess.Popen(args, stdin = subprocess.DEVNULL if text is None
+                          else subprocess.PIPE, stdout = subprocess.PIPE,
+                          universal_newlines = True) as process:
+        if text is not None: # feed the input in a thread to avoid a deadlock
+            def feed():
+                with process.stdin:
+                    process.stdin.write(text)
+            threading.Thread(target = feed, daemon = True).start()
+        out = process.stdout if profile is None else CountingReader(process.stdout)
+        yield out
+    if profile is not None: # bytes of the output read by the caller
+        profile_record('output', start, args = args[1:],
+                       bytes_in = 0 if text is None else len(text.encode()),
+                       bytes_out = out.bytes, returncode = process.returncode)
+
+# A LedgerSession keeps one ledger process running in its interactive mode (no
+# command on the command line) so that the journal and price db are parsed once
+# and every command is answered from memory. Each command line is followed by
+# 'echo <sentinel>' and the output is read up to the sentinel; the prompt
+# printed before each command is removed. A session can be used from several
+# threads (one command at a time) and from asyncio (acommand)
+# if use_ledger_sessions is set (or LEDGER_SESSIONS in environment), ledger_command
+# and ledger_output lease a session from a pool of at most max_ledger_sessions
+# sessions keyed by the digest of the ledger, the price db and the strict flag
+# a leased session is never closed; when the pool is full, the least recently
+# used idle session is closed (waiting for a lease to end if there is none)
+use_ledger_sessions = bool(os.environ.get('LEDGER_SESSIONS'))
+max_ledger_sessions = int(os.environ.get('LEDGER_MAX_SESSIONS', 4))
+
+def quote_argument(arg):
+    # quotes an argument for the command line of an interactive ledger
+    # newlines and tabs (in formats) are written as escapes which ledger expands
+    # in formats; ledger removes backslashes except within single quotes
+    arg = arg.replace('\n', '\\n').replace('\t', '\\t')
+    if arg and not re.search(r'[\s\'"\\]', arg):
+        return arg
+    if "'" not in arg:
+        return "'" + arg + "'"
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+class LedgerSession:
+    prompt = '] '
+
+    def __init__(self, ledger, pricedb = None, strict = True):
+        # ledger is a LedgerFile or anything LedgerFile accepts (which is then
+        # written to a file owned by the session)
+        # pricedb is a LedgerFile or the name of a price file, which is copied
+        # to a file owned by the session since ledger reads it again on a restart
+        # and the name may be of a temporary file (or memfd) that is then reused
+        self.file = ledger if isinstance(ledger, LedgerFile) else LedgerFile(ledger)
+        self.own_file = self.file is not ledger
+        if pricedb is not None and not isinstance(pricedb, LedgerFile):
+            with open(pricedb) as f:
+                pricedb = LedgerFile(f.read())
+            self.own_pricedb = True
+        else:
+            self.own_pricedb = False
+        self.pricedb = pricedb
+        self.options = ['--strict'] if strict else []
+        self.sentinel = 'END-OF-LEDGER-OUTPUT-' + os.urandom(8).hex()
+        self.lock = threading.Lock()
+        self.process = None
+        self.starts = 0
+        self.leases = 0 # number of users of a pooled session
+        self.closed = False
+
+    def start(self):
+        # a closed ledger file may have been removed or its path (of a memfd)
+        # reused for another ledger, so the session cannot be started on it
+        if self.file.closed or (self.pricedb is not None and self.pricedb.closed):
+            raise ValueError('The ledger file of the session is closed')
+        pricedb = [] if self.pricedb is None else ['--price-db', self.pricedb.path]
+        self.process = subprocess.Popen(
+            ['ledger', '-f', self.file.path] + pricedb + self.options,
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+            universal_newlines = True, bufsize = 1)
+        self.starts += 1
+        self.exchange('') # skip anything printed before the first prompt
+
+    def reap(self):
+        # ends the process (if any) and waits for it so that no zombie is left
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except OSError: # unflushed input to a dead process
+                pass
+        self.process = None
+
+    def exchange(self, line):
+        # sends a command line and returns its output
+        self.process.stdin.write(line + '\necho ' + self.sentinel + '\n')
+        self.process.stdin.flush()
+        lines = []
+        for out in self.process.stdout:
+            if out.rstrip('\n').endswith(self.sentinel):
+                lines.append(out.rstrip('\n')[:-len(self.sentinel)])
+                text = ''.join(lines)
+                while text.startswith(self.prompt):
+                    text = text[len(self.prompt):]
+                while text.endswith(self.prompt):
+                    text = text[:-len(self.prompt)]
+                return text
+            lines.append(out)
+        raise EOFError('ledger exited')
+
+    def command(self, args):
+        # runs a command (list of arguments) and returns its output as a string
+        # a process that has died is restarted once; LedgerError if it dies again
+        line = ' '.join(quote_argument(str(arg)) for arg in args)
+        start = time.perf_counter()
+        with self.lock:
+            if self.closed:
+                raise ValueError('Command on a closed LedgerSession')
+            for attempt in range(2):
+                try:
+                    if self.process is None or self.process.poll() is not None:
+                        self.reap()
+                        self.start()
+                    out = self.exchange(line)
+                    break
+                except (EOFError, BrokenPipeError):
+                    self.reap()
+                    if attempt > 0:
+                        raise(LedgerError)
+        if profile is not None:
+            profile_record('session', start, args = list(args),
+                           bytes_in = len(line.encode()),
+                           bytes_out = len(out.encode()), returncode = 0)
+        return out
+
+    async def acommand(self, args):
+        # command for asyncio (run in the default executor of the event loop)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.command, args)
+
+    def close(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self.process.stdin.close() # ledger exits at end of input
+                    self.process.wait(timeout = 5)
+                except (OSError, subprocess.TimeoutExpired):
+                    pass
+            self.reap()
+            if self.own_file:
+                self.file.close()
+            if self.own_pricedb:
+                self.pricedb.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# (digest of ledger, digest of pricedb) : session, least recently used first
+ledger_sessions = {}
+ledger_sessions_lock = threading.Condition() # notified when a lease ends
+
+@contextmanager
+def ledger_session(ledger, pricedb = None, strict = True):
+    # leases the pooled session on ledger (text or LedgerFile) and pricedb (the
+    # name of a price file or a LedgerFile) for the duration of a with block
+    # the price db is identified by the digest of its contents, not by its name
+    pricedb_digest = None if pricedb is None else pricedb.digest \
+        if isinstance(pricedb, LedgerFile) else file_digest(pricedb)
+    key = (ledger_digest(ledger, strict), pricedb_digest)
+    with ledger_sessions_lock:
+        while True:
+            session = ledger_sessions.get(key)
+            if session is not None and session.leases == 0 and (
+                    session.file.closed or (session.pricedb is not None
+                                            and session.pricedb.closed)):
+                ledger_sessions.pop(key).close() # start afresh on this ledger
+                session = None
+            if session is not None:
+                break
+            if len(ledger_sessions) < max_ledger_sessions:
+                session = LedgerSession(ledger, pricedb, strict)
+                break
+            idle = [k for k, s in ledger_sessions.items() if s.leases == 0]
+            if idle:
+                ledger_sessions.pop(idle[0]).close()
+            else:
+                ledger_sessions_lock.wait()
+        ledger_sessions.pop(key, None)
+        ledger_sessions[key] = session # most recently used last
+        session.leases += 1
+    try:
+        yield session
+    finally:
+        with ledger_sessions_lock:
+            session.leases -= 1
+            ledger_sessions_lock.notify_all()
+
+def session_command(ledger, commands, strict = True, session = None):
+    # runs a command on session or, if it is None, on a session leased from the
+    # pool; a '--price-db' in the command is given to the pooled session instead
+    # so that the price db is also parsed only once
+    if session is not None:
+        return session.command(commands)
+    pricedb = None
+    if '--price-db' in commands:
+        i = commands.index('--price-db')
+        pricedb = commands[i + 1]
+        commands = commands[:i] + commands[i + 2:]
+    with ledger_session(ledger, pricedb, strict) as session:
+        return session.command(commands)
+
+def forget_ledger_sessions():
+    # the sessions belong to the process that started them; a forked child
+    # (for example, a worker of a process pool) starts its own
+    global ledger_sessions_lock
+    ledger_sessions.clear()
+    ledger_sessions_lock = threading.Condition()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = forget_ledger_sessions)
+
+@atexit.register
+def close_ledger_sessions():
+    with ledger_sessions_lock:
+        while ledger_sessions:
+            ledger_sessions.popitem()[1].close()
+
+def ledger_table(ledger, commands, format_option, fields, names, regex = [],
+                 strict = True, dtype = None):
+    # runs a ledger report whose format (format_option is '--format' or
+    # '--balance-format') prints the value expressions in fields separated by
+    # tabs, and reads it with the C parser of pd.read_csv into a dataframe with
+    # columns names; numbers may have thousand separators (,)
+    fmt = '\t'.join('%(' + field + ')' for field in fields) + '\n'
+    with ledger_output(ledger, commands + [format_option, fmt],
+                       regex, strict) as out:
+        try:
+            return pd.read_csv(out, sep = '\t', header = None, names = names,
+                               thousands = ',', quoting = csv.QUOTE_NONE,
+                               dtype = dtype)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame(columns = names)
+
+# Balances at cost basis can be computed either by running ledger ('ledger')
+# or in-process from a ledger_list ('native'); 'check' computes both and raises
+# LedgerBackendError if they differ. The backend can be chosen for each call
+# (backend argument) or globally (balance_backend or LEDGER_BACKEND in environment)
+# The native backend is used only when the ledger is given as a ledger_list
+balance_backend = os.environ.get('LEDGER_BACKEND', 'ledger')
 
-def ledger_balance(ledger, regex = [], strict = True):
+class LedgerBackendError(LedgerError):
+    def __init__(self, differences):
+        self.differences = differences
+    def __str__(self):
+        return "Native and ledger balances differ:\n" + str(self.differences)
+
+def journal_postings(journal):
+    # returns the postings in the journal entries of a Journal as numpy arrays:
+    # entry number, account (index in journal.strings with aliases resolved)
+    # and amount at cost basis
+    # amounts are rounded as in ledger_list_to_ledger; a commodity buy is at its
+    # total cost (@@) and a commodity sell at its cost basis (qty * {cost})
+    # an auto balanced posting (only account) gets the imbalance of its entry
+    offsets = journal.column('entry_offsets')
+    entries = np.repeat(np.arange(len(journal)), np.diff(offsets))
+    entry_kind = journal.column('entry_kind')[entries]
+    kind = journal.column('post_kind')
+    accounts = journal.column('post_account')
+    # aliases are sub directives of account declarations
+    resolve = np.arange(len(journal.strings))
+    alias = (entry_kind == Journal.ACCOUNT_DECL) & (kind == Journal.SUB_DIRECTIVE) \
+        & (accounts == journal.string_index.get('alias', -1))
+    resolve[journal.column('post_commodity')[alias]] = \
+        journal.column('entry_details')[entries[alias]]
+    posting = entry_kind == Journal.JOURNAL_ENTRY
+    entries, kind = entries[posting], kind[posting]
+    accounts = resolve[accounts[posting]]
+    qty = journal.column('post_qty')[posting]
+    cost = journal.column('post_cost')[posting]
+    amounts = np.select(
+        [kind == Journal.AMOUNT, kind == Journal.BUY, kind == Journal.SELL],
+        [journal.column('post_amount')[posting].round(2),
+         np.copysign(np.abs(cost).round(2), qty),
+         qty.round(6) * cost.round(6)], np.nan)
+    auto = kind == Journal.AUTO
+    imbalance = np.bincount(entries[~auto], amounts[~auto],
+                            minlength = len(journal))
+    amounts[auto] = -imbalance[entries[auto]]
+    return entries, accounts, amounts
+
+def native_balances(ledger_list, regex = []):
+    # returns the balance (at cost basis) of every account with postings that
+    # matches any of the regex (case insensitive, as in ledger) as a pandas series
+    journal = as_journal(ledger_list)
+    _, accounts, amounts = journal_postings(journal)
+    used = np.unique(accounts)
+    balances = pd.Series(np.bincount(accounts, amounts)[used],
+                         index = np.array(journal.strings, dtype = object)[used])
+    balances = balances.sort_index().round(2)
+    if regex:
+        pattern = '|'.join('(?:' + r + ')' for r in regex)
+        balances = balances[balances.index.str.contains(pattern, case = False)]
+    return balances
+
+def format_balance(balances):
+    # formats a series of account balances like ledger's 'balance' report:
+    # a tree of accounts with the total of each parent, parents with a single
+    # child are shown on the same line and the grand total is shown only
+    # if there is more than one account at the top level
+    totals, own = {}, {}
+    for account, amount in balances.items():
+        parts = tuple(account.split(':'))
+        own[parts] = amount
+        for i in range(1, len(parts) + 1):
+            totals[parts[:i]] = totals.get(parts[:i], 0) + amount
+    children = {}
+    for key in sorted(totals):
+        if round(totals[key], 2) != 0:
+            children.setdefault(key[:-1], []).append(key)
+    def amount_str(amount):
+        return '0' if round(amount, 2) == 0 else '{:,.2f} INR'.format(amount)
+    lines = []
+    def show(key, depth, name):
+        kids = children.get(key, [])
+        if len(kids) == 1 and round(own.get(key, 0), 2) == 0:
+            return show(kids[0], depth, name + ':' + kids[0][-1])
+        lines.append('{:>20}  {:}{:}'.format(amount_str(totals[key]),
+                                             '  ' * depth, name))
+        for kid in kids:
+            show(kid, depth + 1, kid[-1])
+    for key in children.get((), []):
+        show(key, 0, key[0])
+    if len(children.get((), [])) > 1:
+        lines += ['-' * 20, '{:>20}'.format(amount_str(balances.sum()))]
+    return ''.join(line + '\n' for line in lines)
+
+def check_native_balances(ledger_list, regex = [], strict = True):
+    # raises LedgerBackendError if native balances differ from those of ledger
+    native = native_balances(ledger_list, regex)
+    native = native[native != 0]
+    ledger_df = ledger_balances_df(ledger_list, regex, strict, backend = 'ledger')
+    both = pd.merge(pd.DataFrame({'Account' : native.index,
+                                  'native' : native.values}),
+                    ledger_df.rename(columns = {'Amount' : 'ledger'}),
+                    on = 'Account', how = 'outer').fillna(0)
+    differences = both[(both['native'] - both['ledger']).abs() > 0.005]
+    if len(differences) > 0:
+        raise(LedgerBackendError(differences))
+
+class LedgerValidationError(LedgerError):
+    def __init__(self, problems):
+        self.problems = problems
+    def __str__(self):
+        return "Ledger list is not OK:\n" + '\n'.join(
+            'entry {:}: {:}'.format(index, message)
+            for index, message in self.problems)
+
+def is_number(x):
+    return isinstance(x, (int, float, np.number)) and not isinstance(x, bool)
+
+def entry_problems(ledger_entry):
+    # problems in the structure of one entry which would stop it being
+    # converted into a Journal (or into ledger text)
+    try:
+        (directive, details), *tail = ledger_entry
+    except (TypeError, ValueError):
+        return ['first item is not (directive, details)']
+    if not isinstance(directive, str) or not (isinstance(details, str)
+                                               or is_number(details)):
+        return ['directive must be a string and details a string or number']
+    if re.match('account', directive) or re.match('commodity', directive):
+        return ['sub directive is not (name, value): ' + str(item)
+                for item in tail if not (isinstance(item, (tuple, list))
+                                         and len(item) == 2)]
+    if not re.search('^[0-9]+', directive):
+        return ['unknown directive: ' + directive]
+    problems = []
+    numbers = {1 : [], 2 : [1], 4 : [1, 3], 5 : [1, 3, 4]}
+    for item in tail:
+        if not isinstance(item, (tuple, list)) or len(item) not in numbers:
+            problems.append('posting has unknown length: ' + str(item))
+        elif not isinstance(item[0], str) or not all(
+                is_number(item[k]) for k in numbers[len(item)]):
+            problems.append('posting has a bad account or number: ' + str(item))
+    if sum(isinstance(item, (tuple, list)) and len(item) == 1
+           for item in tail) > 1:
+        problems.append('more than one posting without amount')
+    return problems
+
+def ledger_dates(dates):
+    # converts ledger date strings (separated by -, / or .) into numpy datetime64
+    # an auxiliary date after '=' is ignored; bad dates become NaT
+    dates = pd.Series(dates, dtype = str).str.partition('=')[0]
+    return pd.to_datetime(dates.str.replace('[/.]', '-', regex = True),
+                          format = '%Y-%m-%d', errors = 'coerce').values
+
+def validate_ledger_list(ledger_list, strict = True):
+    # checks a ledger_list (or Journal) without running ledger and returns a list
+    # of (index of entry, problem): unknown directives and posting lengths, bad
+    # dates, entries that do not balance at cost basis (as in journal_postings)
+    # and, if strict, accounts and commodities that are not declared
+    # (an alias of an account counts as declared); an empty list means no problem
+    problems = []
+    if isinstance(ledger_list, Journal):
+        journal = ledger_list
+        index = np.arange(len(journal))
+    else:
+        journal = Journal()
+        index = []
+        for i, ledger_entry in enumerate(ledger_list):
+            bad = entry_problems(ledger_entry)
+            problems += [(i, message) for message in bad]
+            if not bad:
+                journal.append(ledger_entry)
+                index.append(i)
+        index = np.array(index, dtype = int)
+    strings = np.array(journal.strings + [''], dtype = object) # -1 gives ''
+    offsets = journal.column('entry_offsets')
+    entry_kind = journal.column('entry_kind')
+    journal_entry = np.flatnonzero(entry_kind == Journal.JOURNAL_ENTRY)
+    post_entries = np.repeat(np.arange(len(journal)), np.diff(offsets))
+    posting = entry_kind[post_entries] == Journal.JOURNAL_ENTRY
+    # dates
+    dates = strings[journal.column('entry_head')[journal_entry]]
+    bad_date = np.isnat(ledger_dates(dates))
+    problems += [(index[e], 'bad date: ' + d) for e, d
+                 in zip(journal_entry[bad_date], dates[bad_date])]
+    # balance at cost basis of entries without an auto balanced posting
+    entries, _, amounts = journal_postings(journal)
+    kind = journal.column('post_kind')[posting]
+    auto = np.bincount(entries[kind == Journal.AUTO], minlength = len(journal))
+    imbalance = np.bincount(entries, amounts, minlength = len(journal)).round(2)
+    unbalanced = np.flatnonzero((entry_kind == Journal.JOURNAL_ENTRY)
+                                & (auto == 0) & (imbalance != 0))
+    problems += [(index[e], 'does not balance by {:.2f}'.format(imbalance[e]))
+                 for e in unbalanced]
+    if strict:
+        # declared names are the details of declarations and the account aliases
+        declared = np.zeros(len(strings), dtype = bool)
+        commodity = np.zeros(len(strings), dtype = bool)
+        details = journal.column('entry_details')
+        declared[details[entry_kind == Journal.ACCOUNT_DECL]] = True
+        commodity[details[entry_kind == Journal.COMMODITY_DECL]] = True
+        commodity[journal.string_index.get(money, -1)] = True
+        accounts = journal.column('post_account')
+        codes = journal.column('post_commodity')
+        alias = (entry_kind[post_entries] == Journal.ACCOUNT_DECL) \
+            & (accounts == journal.string_index.get('alias', -1))
+        declared[codes[alias]] = True
+        for e, a in zip(post_entries[posting & ~declared[accounts]],
+                        accounts[posting & ~declared[accounts]]):
+            problems.append((index[e], 'undeclared account: ' + strings[a]))
+        trade = posting & (codes >= 0) & ~commodity[codes]
+        for e, c in zip(post_entries[trade], codes[trade]):
+            problems.append((index[e], 'undeclared commodity: ' + strings[c]))
+    return sorted(((int(i), message) for i, message in problems),
+                  key = lambda problem: problem[0])
+
+def choose_backend(ledger, backend):
+    # the native backend needs a ledger_list; ledger text always uses ledger
+    if isinstance(ledger, (str, LedgerBuilder)) or (isinstance(ledger, LedgerFile)
+                                   and ledger.ledger_list is None):
+        return 'ledger'
+    return balance_backend if backend is None else backend
+
+def ledger_balance(ledger, regex = [], strict = True, backend = None):
     # run 'balance' command (at cost basis) and return result as a string
     # the imbalance is parsed and returned as a float for diagnostic purposes
+    backend = choose_backend(ledger, backend)
+    if backend == 'native':
+        balances = native_balances(ledger, regex)
+        return(format_balance(balances), float(round(balances.sum(), 2)))
+    if backend == 'check':
+        check_native_balances(ledger, regex, strict)
     ledger_out = ledger_command(ledger, ['-B', 'balance'], regex, strict)
     imbalance = myfloat(io.StringIO(ledger_out).readlines()[-1])
     return(ledger_out, imbalance)
@@ -185,60 +1273,262 @@ def ledger_balance(ledger, regex = [], strict = True):
 def ledger_balance_MV(ledger, pricedb, regex = [], strict = True):
     # run 'balance' command (at market value) and return result as a string
     # the imbalance is parsed and returned as a float for diagnostic purposes
+    # pricedb is the name of a price file or a PriceStore
+    if isinstance(pricedb, PriceStore):
+        with LedgerFile(pricedb.to_ledger()) as pricedb_file:
+            return ledger_balance_MV(ledger, pricedb_file.path, regex, strict)
     ledger_out = ledger_command(
         ledger, ['--price-db', pricedb, '-V', 'balance'], regex, strict)
     imbalance = myfloat(io.StringIO(ledger_out).readlines()[-1])
     return(ledger_out, imbalance)
 
-def ledger_balances_df(ledger, regex = [], strict = True):
+def ledger_balances_df(ledger, regex = [], strict = True, backend = None):
     # run 'balance' command (at cost basis) and parse result into pandas dataframe
-    out = ledger_command(ledger, ['-B', '--flat', 'balance'], regex, strict)
-    csv = io.StringIO(out.partition('---')[0].replace(',', ''))
-    df = pd.read_csv(csv, sep = '\s+INR\s+', header = None, engine = 'python',
-                     names = ['Amount', 'Account'])
-    return df
+    backend = choose_backend(ledger, backend)
+    if backend == 'native':
+        balances = native_balances(ledger, regex)
+        balances = balances[balances != 0]
+        return pd.DataFrame({'Amount' : balances.values,
+                             'Account' : balances.index})
+    if backend == 'check':
+        check_native_balances(ledger, regex, strict)
+    # one tab separated line per account (amount, full account name), no total
+    return ledger_table(ledger, ['-B', '--flat', '--no-total', 'balance'],
+                        '--balance-format',
+                        ['quantity(scrub(display_total))',
+                         'partial_account(true)'],
+                        ['Amount', 'Account'], regex, strict,
+                        dtype = {'Amount' : float, 'Account' : str})
+
+def cumulative_balances(accounts, dates, amounts, cutoffs):
+    # balance of each account as on each of the cutoffs (postings dated on or
+    # before the cutoff) as a dataframe with one row per account and one column
+    # per cutoff, from arrays of the account, date and amount of the postings
+    cut = ledger_dates(cutoffs)
+    order = np.argsort(cut, kind = 'stable')
+    bucket = np.searchsorted(cut[order], dates, side = 'left')
+    keep = bucket < len(cut) # postings after the last cutoff
+    table = pd.DataFrame({'Account' : accounts[keep], 'bucket' : bucket[keep],
+                          'Amount' : amounts[keep]}).pivot_table(
+        index = 'Account', columns = 'bucket', values = 'Amount',
+        aggfunc = 'sum', fill_value = 0)
+    table = table.reindex(columns = range(len(cut)), fill_value = 0).cumsum(axis = 1)
+    balances = pd.DataFrame(table.values[:, np.argsort(order)],
+                            index = table.index, columns = list(cutoffs)).round(2)
+    return balances[(balances != 0).any(axis = 1)].sort_index()
+
+def native_balances_at(ledger_list, cutoffs, regex = []):
+    # cumulative_balances of the postings of a ledger_list at cost basis
+    journal = as_journal(ledger_list)
+    entries, accounts, amounts = journal_postings(journal)
+    strings = np.array(journal.strings, dtype = object)
+    dates = ledger_dates(strings[journal.column('entry_head')])[entries]
+    balances = cumulative_balances(strings[accounts], dates, amounts, cutoffs)
+    if regex:
+        pattern = '|'.join('(?:' + r + ')' for r in regex)
+        balances = balances[balances.index.str.contains(pattern, case = False)]
+    return balances
+
+def ledger_balances_at(ledger, cutoffs, regex = [], strict = True,
+                       backend = None):
+    # balances (at cost basis) of the accounts as on each of the cutoff dates
+    # as a dataframe with one row per account and one column per cutoff, computed
+    # in one pass over the postings (a single 'register' run for ledger)
+    # movements between the cutoffs are given by .diff(axis = 1)
+    backend = choose_backend(ledger, backend)
+    if backend in ['native', 'check']:
+        native = native_balances_at(ledger, cutoffs, regex)
+        if backend == 'native':
+            return native
+    postings = ledger_table(ledger, ['-B', '--date-format', '%Y-%m-%d',
+                                     'register'], '--format',
+                            ['date', 'account', 'quantity(scrub(display_amount))'],
+                            ['date', 'Account', 'Amount'], regex, strict,
+                            dtype = {'date' : str, 'Account' : str,
+                                     'Amount' : float})
+    balances = cumulative_balances(postings['Account'].values,
+                                   ledger_dates(postings['date']),
+                                   postings['Amount'].values, cutoffs)
+    if backend == 'check':
+        differences = native.sub(balances, fill_value = 0)
+        differences = differences[(differences.abs() > 0.005).any(axis = 1)]
+        if len(differences) > 0:
+            raise(LedgerBackendError(differences))
+    return balances
 
 def ledger_qty_basis_df(ledger, pricedb = None, regex = [], strict = True):
-    # returns quantity balances of all commodities as a pandas dataframe
-    # list of all commodities is obtained using the 'commodities' command
-    # for each commodity, the 'balance' command is run without prices to get quantity balances
-    # this command can take several seconds to run, so it reports progress regularly
-    commodities = ledger_command(ledger, ['commodities'], regex, strict).split('\n')
-    data = pd.DataFrame()
-    nc = len(commodities)
-    print('Computing quantities, cost and value of {:} "commodities"'.format(nc))
-    n = 0
-    for comm in commodities:
-        comm = comm.replace('"', '')
-        clist = ['-l', 'commodity=~/' + comm + '/', 'bal']
-        if not comm in ['', 'INR']:
-            d = {'commodity' : comm}
-            s = ledger_command(ledger, clist, regex, strict)
-            if s != '':
-                d['qty'] = myfloat(s, comm)
-                s = ledger_command(ledger, ['-B'] + clist, regex, strict)
-                d['cost'] = myfloat(s)
-                if pricedb is not None:
-                    s = ledger_command(
-                        ledger, ['-V', '--price-db', pricedb] + clist,
-                        regex, strict)
-                    d['value'] = myfloat(s)
-                data = data.append(d, ignore_index=True)
-        n += 1
-        if n % 5 == 0: print('{:} of {:} commodities processed'.format(n, nc))
-    print('Completed all {:} "commodities"'.format(nc))
+    # returns quantity, cost and value of all commodities as a pandas dataframe
+    # a single 'register' run prints commodity, quantity, cost and market value
+    # of every posting; these are then summed by commodity so that the time taken
+    # grows with the number of postings and not with the number of commodities
+    # pricedb is the name of a price file or a PriceStore (which is written to a
+    # temporary price file so that ledger values the commodities as with -V)
+    fields = ['commodity(amount)', 'quantity(amount)', 'quantity(cost)']
+    names = ['commodity', 'qty', 'cost']
+    price = []
+    if isinstance(pricedb, PriceStore):
+        with LedgerFile(pricedb.to_ledger()) as pricedb_file:
+            return ledger_qty_basis_df(ledger, pricedb_file.path, regex, strict)
+    if pricedb is not None:
+        fields += ['quantity(market(amount))']
+        names += ['value']
+        price = ['--price-db', pricedb]
+    postings = ledger_table(ledger, price + ['register'], '--format', fields,
+                            names, regex, strict, dtype = {'commodity' : str})
+    if len(postings) == 0:
+        return postings
+    # commodity(amount) gives the symbol without lot annotations, quoted if it
+    # contains spaces or special characters; only the quotes are removed
+    postings['commodity'] = postings['commodity'].fillna('').str.replace(
+        r'^"(.*)"$', r'\1', regex = True)
+    postings = postings[~postings['commodity'].isin(['', money])]
+    data = postings.groupby('commodity', as_index = False, sort = True).sum()
+    data = data[data['qty'].round(6) != 0].reset_index(drop = True)
     return data
 
+def price_times(dates):
+    # converts the dates (with or without a time) of price directives into
+    # timestamps; dates may be separated by -, / or . and formats may be mixed
+    return pd.to_datetime(pd.Series(dates, dtype = str).str.replace(
+        '[/.]', '-', regex = True), format = 'mixed')
+
+class PriceStore:
+    # prices of commodities as a dataframe with columns date (as written in the
+    # ledger price directive), code, price and unit (the commodity in which the
+    # price is given) and the parsed date (time), without duplicate (time, code)
+    # and sorted by code and time; the latest price of a commodity as on any date
+    # is looked up using a per commodity index of times and prices
+    # the store can be saved (save) and loaded (load) in binary form
+    columns = ['date', 'code', 'price', 'unit']
+
+    def __init__(self, prices = None):
+        self.prices = pd.DataFrame(columns = self.columns + ['time']) \
+            if prices is None else prices
+        if 'unit' not in self.prices: # saved before units were kept
+            self.prices = self.prices.assign(unit = money)
+        if 'time' not in self.prices:
+            self.prices = self.prices.assign(time = price_times(
+                self.prices['date']).values)
+        self.index = None
+
+    def add(self, prices):
+        # adds a dataframe of prices (later prices replace earlier ones for the
+        # same date and code) and returns the store; unit defaults to money
+        if 'unit' not in prices:
+            prices = prices.assign(unit = money)
+        prices = prices[self.columns].astype(
+            {'date' : str, 'code' : str, 'price' : float, 'unit' : str})
+        prices = prices.assign(time = price_times(prices['date']).values)
+        prices = pd.concat([self.prices, prices], ignore_index = True).astype(
+            {'price' : float})
+        prices = prices.drop_duplicates(['time', 'code'], keep = 'last')
+        self.prices = prices.sort_values(['code', 'time'], kind = 'stable'
+                                         ).reset_index(drop = True)
+        self.index = None
+        return self
+
+    def add_files(self, files, date):
+        # adds the prices as on date from a bunch of price files
+        # the price file is a csv file with two columns: code and price
+        return self.add(pd.concat([pd.read_csv(f, header =0) for f in files],
+                                  ignore_index = True).assign(date = date))
+
+    def add_pricedb(self, filename):
+        # adds the price directives (P date "code" price unit, where the unit
+        # may also come before the price) in a ledger file; the unit is a single
+        # commodity (quoted or not) and anything after it (a comment) is ignored
+        with open(filename) as f:
+            lines = pd.Series(f.read().splitlines(), dtype = str)
+        unit = r'"[^"]+"|[^\s\d.,;"-]+'
+        prices = lines.str.extract(
+            r'^P\s+(?P<date>\S+(?:\s+\d+:\d+(?::\d+)?)?)\s+(?P<code>"[^"]+"|\S+)'
+            r'\s+(?:(?P<before>' + unit + r')\s*)?(?P<price>-?[\d,]*\.?\d+)'
+            r'(?:\s*(?P<after>' + unit + '))?')
+        prices = prices.dropna(subset = ['date', 'code', 'price'])
+        prices['price'] = prices['price'].str.replace(',', '').astype(float)
+        prices['unit'] = prices['before'].fillna(prices['after']).fillna(
+            '').str.strip('"')
+        prices['code'] = prices['code'].str.strip('"')
+        return self.add(prices)
+
+    def latest(self, date = None):
+        # returns the latest price of each commodity on or before date
+        # (the latest of all if date is None) as a series indexed by code
+        prices = self.prices
+        if date is not None:
+            prices = prices[prices['time'] <= price_times([date])[0]]
+        return prices.groupby('code')['price'].last()
+
+    def price(self, code, date = None):
+        # returns the latest price of one commodity on or before date
+        if self.index is None:
+            self.index = {code : (group['time'].to_numpy(),
+                                  group['price'].to_numpy())
+                          for code, group in self.prices.groupby('code')}
+        if code not in self.index:
+            return np.nan
+        dates, prices = self.index[code]
+        n = len(dates) if date is None else np.searchsorted(
+            dates, price_times([date]).to_numpy()[0], side = 'right')
+        return prices[n - 1] if n > 0 else np.nan
+
+    def to_ledger(self):
+        # returns the prices as price directives in ledger's format
+        if len(self.prices) == 0:
+            return ''
+        price = np.char.mod('%.6f', self.prices['price'].to_numpy(float))
+        # units other than plain names (for example, with spaces) are quoted
+        units = self.prices['unit'].astype(str)
+        unit = (' ' + units.where(units.str.fullmatch(r'[A-Za-z_]*'),
+                                  '"' + units + '"')).where(units != '', '')
+        lines = 'P ' + self.prices['date'] + ' "' + self.prices['code'] + '" ' \
+            + price + unit + '\n'
+        return ''.join(lines)
+
+    def write(self, filename):
+        with open(filename, 'w') as out:
+            out.write(self.to_ledger())
+
+    def save(self, filename):
+        self.prices.to_pickle(filename)
+
+    @classmethod
+    def load(cls, filename):
+        return cls(pd.read_pickle(filename))
+
 def make_price_file(files, date):
     # read a bunch of price files and return a string with price entries in ledger's format
     # the price file is a csv file with two columns: code and price
-    prices = pd.DataFrame()
-    for f in files:
-        prices = prices.append(pd.read_csv(f, header =0))
-    with io.StringIO() as out:
-        for _, code, price in prices.itertuples(): # the '_' is for the row name
-            print(ledger_format('price').format(date, code, price), file = out)
-        return out.getvalue()
+    return PriceStore().add_files(files, date).to_ledger()
+
+def run_task_graph(tasks, workers = None, processes = False):
+    # run a dict of tasks {name : (function, [names of tasks it depends on])}
+    # on a pool of threads (or processes if processes = True)
+    # each function is called with the results of its dependencies as arguments
+    # and is started as soon as these are available; returns {name : result}
+    # when profiling, each task is recorded as a stage (see run_stage)
+    for name, (_, deps) in tasks.items():
+        missing = [d for d in deps if d not in tasks]
+        assert not missing, 'Task {:} has unknown dependencies {:}'.format(
+            name, missing)
+    pending = dict(tasks)
+    results = {}
+    running = {}
+    pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool_class(max_workers = workers) as pool:
+        while pending or running:
+            for name, (function, deps) in list(pending.items()):
+                if all(d in results for d in deps):
+                    future = submit_stage(pool, name, function,
+                                          *[results[d] for d in deps],
+                                          processes = processes)
+                    running[future] = name
+                    del pending[name]
+            assert running, 'Circular dependencies among ' + str(list(pending))
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = stage_result(future, processes)
+    return results
 
 class Numpy_int64_Encoder(json.JSONEncoder):
     # if a large number is an integer, numpy uses 64 bit integers instead of float
@@ -250,7 +1540,9 @@ class Numpy_int64_Encoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 def save_json(ledger_list, filename):
-    # dump the ledger_list into a json file using the Numpy_int64_Encoder
+    # dump the ledger_list (or Journal) into a json file using the Numpy_int64_Encoder
+    if isinstance(ledger_list, Journal):
+        ledger_list = ledger_list.to_ledger_list()
     with open(filename, 'w') as out:
         json.dump(ledger_list, out, indent = 1, cls=Numpy_int64_Encoder)
 
@@ -1,117 +1,287 @@
 import numpy as np
 import pandas as pd
-import sys, io, os, datetime
+import sys, io, os, datetime, importlib, importlib.util, types
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from ledger_functions import *
 
-if len(sys.argv) < 2 : 
-    print("Argument not provided for data_path. Exiting ...\n")
-    exit()
-data_path = sys.argv[1]
-sys.path += [os.path.realpath(data_path)] # annual_settings & other python scripts are in data_path
-os.chdir(data_path) # all the data files are in data_path 
-from annual_settings import * # this contains file names and other year specific variables
-from make_je_list import je_list # je_list contains the journal entries for the year
-
-############          Opending ledger and balance sheet         ############
-
-# Opening ledger
-opening_ledger_list = make_opening_ledger_list(
-    fnames, prev_yr_end, opg_balance_account)
-opening_ledger = ledger_list_to_ledger(opening_ledger_list)
-ledger_balance_out, imbalance = ledger_balance(opening_ledger)
-assert imbalance == 0
-with open(fnames['opening_ledger'], 'w') as out:
-    print(opening_ledger, file = out)
-save_json(opening_ledger_list, fnames['opening_ledger_json'])
-
-## Opending balance sheet at historical cost
-print('Opening Balance Sheet\n' + ledger_balance_out)
-
-## Opending assets at market value
-assert 'pre_opening_pricedb' in fnames.keys() or \
-    'opening_price_data' in fnames.keys(), \
-    'Neither opening pricedb nor opening price data is available'
-with open(fnames['opening_pricedb'], 'w') as out:
-    if 'pre_opening_pricedb' in fnames.keys():
-        print(open(fnames['pre_opening_pricedb']).read(), file = out)
-    if 'opening_price_data' in fnames.keys():
-        print(make_price_file(fnames['opening_price_data'],
-                              opening_datetime), file = out)
-ledger_balance_mv_out,imbalance = ledger_balance_MV(
-    opening_ledger, fnames['opening_pricedb'], ['assets'])
-print('Market Value Opening Assets\n' + ledger_balance_mv_out)
-
-
-###########   Trial Balance after updating ledger with entries for the year  ##########
-
-ledger_list = opening_ledger_list + je_list # this is imported from make_je_list
-ledger = ledger_list_to_ledger(ledger_list)
-# print(ledger)
-ledger_balance_out, imbalance = ledger_balance(ledger)
-assert imbalance == 0
-# print('Trial Balance\n' + ledger_balance_out)
-
-
-########## Income Statement, Balance Sheet, Analysis of Savings ##########
-
-# Split Trial Balance into Income Statement and Balance Sheet with closing entry
-surplus = ledger_balance(ledger, regex = income_statement_accounts)[1]
-year_end_entry = [(year_end, "Year end transfer of surplus into equity"),
-                  ('surplus', -surplus), (annual_savings_account, surplus)]
-closing_ledger_list = ledger_list + [year_end_entry]
-closing_ledger = ledger_list_to_ledger(closing_ledger_list)
-with open(fnames['pre_closing'], 'w') as out:
-    print(closing_ledger, file = out)
-save_json(closing_ledger_list, fnames['pre_closing_json'])
-
-# Income statement (after closing entry, this has zero balance)
-income_statement = ledger_balance(closing_ledger, regex = income_statement_accounts)[0]
-print('Income Statement\n' + income_statement)
-
-# Balance Sheet (after closing entry, this balance sheet tallies)
-balance_sheet, imbalance = ledger_balance(closing_ledger, regex = balance_sheet_accounts)
-assert imbalance == 0
-print('Balance Sheet\n' + balance_sheet)
-
-# For full closing, every income statement account is reduced to zero balance
-# to start the next year on a clean slate
-income_statement_df = ledger_balances_df(closing_ledger, regex = income_statement_accounts)
-closingje = [(year_end, 'Year end closure of income statement')] +\
-            [(account, -amount) for (_, amount, account)
-             in income_statement_df.itertuples()]
-post_closing_ledger_list = closing_ledger_list + [closingje]
-post_closing_ledger = ledger_list_to_ledger(post_closing_ledger_list)
-with open(fnames['post_closing'], 'w') as out:
-    print(post_closing_ledger, file = out)
-save_json(post_closing_ledger_list, fnames['post_closing_json'])
+# The accounts of a year are prepared from the data files in its data path using
+# the settings in annual_settings.py (file names and other year specific
+# variables) and the journal entries returned by make_je_list.py
+# Several years (data paths) can be prepared in one run: the post closing ledger
+# of each year is passed directly to the next year as its pre opening ledger
+
+############          Settings and journal entries of a year         ############
+
+def load_year(data_path):
+    # returns the settings of the year in data_path (the public variables of its
+    # annual_settings.py with fnames made relative to data_path) and je_list
+    # make_je_list.py can be in data_path or in the folder of this script
+    data_path = os.path.realpath(data_path)
+    spec = importlib.util.spec_from_file_location(
+        'annual_settings', os.path.join(data_path, 'annual_settings.py'))
+    annual_settings = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(annual_settings)
+    settings = types.SimpleNamespace(**{
+        name : value for name, value in vars(annual_settings).items()
+        if not name.startswith('_') and not isinstance(value, types.ModuleType)
+        and not callable(value)})
+    settings.data_path = data_path
+    settings.fnames = {
+        key : [os.path.join(data_path, f) for f in value]
+        if isinstance(value, list) else os.path.join(data_path, value)
+        for key, value in annual_settings.fnames.items()}
+    # make_je_list imports annual_settings and other modules from data_path
+    # and may read files relative to data_path
+    old_path, old_cwd = list(sys.path), os.getcwd()
+    sys.modules['annual_settings'] = annual_settings
+    sys.path.insert(0, data_path)
+    os.chdir(data_path)
+    try:
+        sys.modules.pop('make_je_list', None)
+        je_list = importlib.import_module('make_je_list').je_list
+    finally:
+        os.chdir(old_cwd)
+        sys.path[:] = old_path
+        # forget the modules of this year so that the next year gets its own
+        for name, module in list(sys.modules.items()):
+            if name in ['annual_settings', 'make_je_list'] or os.path.dirname(
+                    getattr(module, '__file__', None) or '') == data_path:
+                del sys.modules[name]
+    return settings, je_list
+
+
+############          Stages of preparing the accounts         ############
+# Each stage is a function of the settings and of the results of the stages that
+# it depends on (see the task graphs below) so that independent reports run in
+# parallel. The ledgers are passed to the reports as LedgerFiles which are written
+# only once and which also carry the ledger_list for the native balance backend
+
+def opening_balance_sheet(settings, opening_ledger):
+    # Opending balance sheet at historical cost
+    ledger_balance_out, imbalance = ledger_balance(opening_ledger)
+    assert imbalance == 0
+    return ledger_balance_out
+
+def opening_balance_sheet_mv(settings, opening_ledger):
+    # Opending assets at market value
+    return ledger_balance_MV(
+        opening_ledger, settings.fnames['opening_pricedb'], ['assets'])[0]
+
+def trial_balance(settings, ledger):
+    # Trial Balance after updating ledger with entries for the year
+    ledger_balance_out, imbalance = ledger_balance(ledger)
+    assert imbalance == 0
+    return ledger_balance_out
+
+def closing(settings, ledger):
+    # Split Trial Balance into Income Statement and Balance Sheet with closing entry
+    surplus = ledger_balance(ledger, regex = income_statement_accounts)[1]
+    year_end_entry = [(settings.year_end,
+                       "Year end transfer of surplus into equity"),
+                      ('surplus', -surplus),
+                      (settings.annual_savings_account, surplus)]
+    closing_ledger_list = ledger.ledger_list + [year_end_entry]
+    fnames = settings.fnames
+    closing_ledger = LedgerFile(closing_ledger_list, fnames['pre_closing'])
+    save_json(closing_ledger_list, fnames['pre_closing_json'])
+    if 'pre_closing_snapshot' in fnames.keys():
+        save_journal(closing_ledger_list, fnames['pre_closing_snapshot'])
+    return closing_ledger
+
+def income_statement(settings, closing_ledger):
+    # Income statement (after closing entry, this has zero balance)
+    return ledger_balance(
+        closing_ledger, regex = income_statement_accounts)[0]
+
+def balance_sheet(settings, closing_ledger):
+    # Balance Sheet (after closing entry, this balance sheet tallies)
+    balance_sheet, imbalance = ledger_balance(
+        closing_ledger, regex = balance_sheet_accounts)
+    assert imbalance == 0
+    return balance_sheet
 
+def post_closing(settings, closing_ledger):
+    # For full closing, every income statement account is reduced to zero balance
+    # to start the next year on a clean slate
+    income_statement_df = ledger_balances_df(
+        closing_ledger, regex = income_statement_accounts)
+    closingje = [(settings.year_end, 'Year end closure of income statement')] +\
+                [(account, -amount) for (_, amount, account)
+                 in income_statement_df.itertuples()]
+    post_closing_ledger_list = closing_ledger.ledger_list + [closingje]
+    fnames = settings.fnames
+    with open(fnames['post_closing'], 'w') as out:
+        ledger_list_to_ledger(post_closing_ledger_list, out)
+    save_json(post_closing_ledger_list, fnames['post_closing_json'])
+    if 'post_closing_snapshot' in fnames.keys():
+        save_journal(post_closing_ledger_list, fnames['post_closing_snapshot'])
+    return post_closing_ledger_list
+
+def balance_sheet_balances(settings, opening_ledger, closing_ledger):
+    # balance sheet accounts in the opening and closing ledgers as the columns
+    # prev_yr_end and year_end; all the postings of each ledger are counted (not
+    # those up to a cut-off date) so that entries of the year dated on or before
+    # the previous year end (for example, restated corrections) or after the
+    # year end are not left out of the deployment of savings
+    balances = [ledger_balances_df(ledger, regex = balance_sheet_accounts
+                                   ).set_index('Account')['Amount']
+                for ledger in [opening_ledger, closing_ledger]]
+    return pd.concat(balances, axis = 1, keys = [
+        settings.prev_yr_end, settings.year_end]).fillna(0)
 
 ########## At this stage the accounting is complete ##########
 ########## Rest is memorandum items and other analysis ##########
 
-# Market Value of Assets
-with open(fnames['closing_pricedb'], 'w') as out:
-    print(make_price_file(fnames['closing_price_data'], closing_datetime),
-          file = out)
-balance_sheet_mv,imbalance = ledger_balance_MV(
-    closing_ledger, fnames['closing_pricedb'], regex = ['assets'])
-print('Market Value Closing Assets\n' + balance_sheet_mv)
-
-# Savings and their deployment
-opgBS = ledger_balances_df(opening_ledger, regex = balance_sheet_accounts) 
-clsgBS = ledger_balances_df(closing_ledger, regex = balance_sheet_accounts) 
-cashflow = pd.merge(opgBS, clsgBS, on = 'Account',
-                    suffixes = ['_open', '_close'], how = 'outer').fillna(0)
-with io.StringIO() as out:
-    print(datetime.date(year, 3, 31), 'Cash flow statement', file =out)
-    for _, Amount_open, Account, Amount_close in cashflow.itertuples():
-        print(ledger_format().format(Account, Amount_close - Amount_open),
-                                     file = out)
-    cashflow_ledger = out.getvalue()
-ledger_balance_out, imbalance = ledger_balance(cashflow_ledger, strict = False)
-assert imbalance == 0
-print('Deployment of Savings\n' + ledger_balance_out)
-
-# Write out commodity qty cost and value
-qty_cost_value = ledger_qty_basis_df(closing_ledger, fnames['closing_pricedb'])
-qty_cost_value.to_csv(fnames['closing_commodity_balances'], index = False)
+def closing_balance_sheet_mv(settings, closing_ledger):
+    # Market Value of Assets
+    return ledger_balance_MV(closing_ledger, settings.fnames['closing_pricedb'],
+                             regex = ['assets'])[0]
+
+def deployment_of_savings(settings, balances):
+    # Savings and their deployment: the change in each balance sheet account
+    cashflow = balances[settings.year_end] - balances[settings.prev_yr_end]
+    cashflow = cashflow[cashflow.round(2) != 0]
+    assert round(cashflow.sum(), 2) == 0
+    return format_balance(cashflow)
+
+def commodity_qty_cost_value(settings, closing_ledger, closing_prices):
+    # Write out commodity qty cost and value (at prices in the closing price store)
+    qty_cost_value = ledger_qty_basis_df(closing_ledger, closing_prices)
+    qty_cost_value.to_csv(settings.fnames['closing_commodity_balances'],
+                          index = False)
+    return qty_cost_value
+
+def stage_tasks(settings, stages):
+    # task graph (see run_task_graph) of a list of (name, stage, dependencies)
+    return {name : (partial(stage, settings), dependencies)
+            for name, stage, dependencies in stages}
+
+def accounting_tasks(settings):
+    # stages needed to close the accounts (run on threads)
+    return stage_tasks(settings, [
+        ('opening_balance_sheet', opening_balance_sheet, ['opening_ledger']),
+        ('opening_balance_sheet_mv', opening_balance_sheet_mv,
+         ['opening_ledger']),
+        ('trial_balance', trial_balance, ['ledger']),
+        ('closing', closing, ['ledger']),
+        ('income_statement', income_statement, ['closing']),
+        ('balance_sheet', balance_sheet, ['closing']),
+        ('post_closing', post_closing, ['closing']),
+        ('balance_sheet_balances', balance_sheet_balances,
+         ['opening_ledger', 'closing'])])
+
+def memorandum_tasks(settings):
+    # memorandum reports on which no later stage or year depends
+    # (run on processes)
+    return stage_tasks(settings, [
+        ('closing_balance_sheet_mv', closing_balance_sheet_mv, ['closing']),
+        ('deployment_of_savings', deployment_of_savings,
+         ['balance_sheet_balances']),
+        ('commodity_qty_cost_value', commodity_qty_cost_value,
+         ['closing', 'closing_prices'])])
+
+@rendering_cache() # the opening, closing and post closing ledgers share entries
+def close_accounts(settings, je_list, pre_opening_ledger_list = None,
+                   workers = None):
+    # prepares the opening ledger and price files of the year and runs the
+    # accounting stages; returns the results of the stages
+    fnames = settings.fnames
+    # Opening ledger
+    opening_ledger_list = make_opening_ledger_list(
+        fnames, settings.prev_yr_end, settings.opg_balance_account,
+        pre_opening_ledger_list)
+    # the journal is checked in-process before any file is written or ledger run
+    # undeclared accounts and commodities (found only in strict mode) are
+    # reported as warnings as ledger --strict does; other problems are errors
+    problems = validate_ledger_list(opening_ledger_list + je_list, strict = False)
+    if problems:
+        raise(LedgerValidationError(problems))
+    for index, warning in validate_ledger_list(opening_ledger_list + je_list):
+        print('Warning: entry {:}: {:}'.format(index, warning))
+    opening_ledger = LedgerFile(opening_ledger_list, fnames['opening_ledger'])
+    save_json(opening_ledger_list, fnames['opening_ledger_json'])
+    if 'opening_ledger_snapshot' in fnames.keys():
+        save_journal(opening_ledger_list, fnames['opening_ledger_snapshot'])
+    ## Opening and closing prices for market value
+    ## the prices of the previous year are loaded from its binary price store
+    ## if there is one (see PriceStore.save) else parsed from its price file
+    assert 'pre_opening_price_store' in fnames.keys() or \
+        'pre_opening_pricedb' in fnames.keys() or \
+        'opening_price_data' in fnames.keys(), \
+        'Neither opening pricedb nor opening price data is available'
+    opening_prices = PriceStore()
+    if 'pre_opening_price_store' in fnames.keys():
+        opening_prices = PriceStore.load(fnames['pre_opening_price_store'])
+    elif 'pre_opening_pricedb' in fnames.keys():
+        opening_prices.add_pricedb(fnames['pre_opening_pricedb'])
+    if 'opening_price_data' in fnames.keys():
+        opening_prices.add_files(fnames['opening_price_data'],
+                                 settings.opening_datetime)
+    opening_prices.write(fnames['opening_pricedb'])
+    closing_prices = PriceStore().add_files(fnames['closing_price_data'],
+                                            settings.closing_datetime)
+    closing_prices.write(fnames['closing_pricedb'])
+    if 'closing_price_store' in fnames.keys():
+        closing_prices.save(fnames['closing_price_store'])
+    # Ledger updated with entries for the year (a temporary file)
+    with LedgerFile(opening_ledger_list + je_list) as ledger:
+        # print(ledger_list_to_ledger(ledger.ledger_list))
+        tasks = accounting_tasks(settings)
+        tasks['opening_ledger'] = (lambda: opening_ledger, [])
+        tasks['ledger'] = (lambda: ledger, [])
+        tasks['closing_prices'] = (lambda: closing_prices, [])
+        return run_task_graph(tasks, workers)
+
+def print_reports(results):
+    # the reports are printed in the same order as when the stages ran one by one
+    print('Opening Balance Sheet\n' + results['opening_balance_sheet'])
+    print('Market Value Opening Assets\n' + results['opening_balance_sheet_mv'])
+    # print('Trial Balance\n' + results['trial_balance'])
+    print('Income Statement\n' + results['income_statement'])
+    print('Balance Sheet\n' + results['balance_sheet'])
+    print('Market Value Closing Assets\n' + results['closing_balance_sheet_mv'])
+    print('Deployment of Savings\n' + results['deployment_of_savings'])
+    print('Computed quantities, cost and value of {:} "commodities"'.format(
+        len(results['commodity_qty_cost_value'])))
+
+def prepare_accounts(data_paths, workers = None):
+    # prepares the accounts of the years in data_paths (in chronological order)
+    # the memorandum reports of a year run in a process pool while the next
+    # year is being closed; all reports are printed at the end year by year
+    post_closing_ledger_list = None
+    years = []
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        for data_path in data_paths:
+            settings, je_list = load_year(data_path)
+            results = close_accounts(settings, je_list, post_closing_ledger_list,
+                                     workers)
+            post_closing_ledger_list = results['post_closing']
+            memorandum = {name : submit_stage(pool, name, function,
+                                              *[results[d] for d in deps],
+                                              processes = True)
+                          for name, (function, deps)
+                          in memorandum_tasks(settings).items()}
+            years.append((settings, results, memorandum))
+        for settings, results, memorandum in years:
+            results.update({name : stage_result(future, processes = True)
+                            for name, future in memorandum.items()})
+            if len(data_paths) > 1:
+                print('########## Accounts for {:} ##########\n'.format(
+                    settings.data_path))
+            print_reports(results)
+    return [results for _, results, _ in years]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 :
+        print("Argument not provided for data_path. Exiting ...\n")
+        exit()
+    # the independent ledger reports are run in parallel on this many workers
+    workers = int(os.environ.get('LEDGER_WORKERS', os.cpu_count()))
+    prepare_accounts(sys.argv[1:], workers) # one or more data paths
+    print('Ledger check cache: {hits} hits, {misses} misses'.format(
+        **ledger_check_stats))
+    if profile is not None: # LEDGER_PROFILE is the name of the json profile
+        save_profile(os.environ['LEDGER_PROFILE'])
+        print('Profile by stage (seconds, bytes)')
+        print(profile_summary().to_string(float_format = '{:.3f}'.format))